@@ -27,6 +27,21 @@ builtin.module {
     }) to <[0, 0], [1, 1]>
     func.return
   }
+
+  func.func @bufferized_stencil_with_args(%a : !stencil.field<[-1,1023]x[-1,511]xtensor<512xf32>>, %b : !stencil.field<[-1,1023]x[-1,511]xtensor<512xf32>>) {
+    %0 = tensor.empty() : tensor<510xf32>
+    %1 = tensor.empty() : tensor<510xf32>
+    csl_stencil.apply(%a : !stencil.field<[-1,1023]x[-1,511]xtensor<512xf32>>, %0 : tensor<510xf32>, %1 : tensor<510xf32>) outs (%b : !stencil.field<[-1,1023]x[-1,511]xtensor<512xf32>>) <{"swaps" = [#csl_stencil.exchange<to [1, 0]>, #csl_stencil.exchange<to [-1, 0]>, #csl_stencil.exchange<to [0, 1]>, #csl_stencil.exchange<to [0, -1]>], "topo" = #dmp.topo<1022x510>, "num_chunks" = 2 : i64, "bounds" = #stencil.bounds<[0, 0], [1, 1]>, "operandSegmentSizes" = array<i32: 1, 1, 1, 1>}> ({
+    ^0(%2 : tensor<4x255xf32>, %3 : index, %4 : tensor<510xf32>):
+      csl_stencil.yield %4 : tensor<510xf32>
+    }, {
+    ^1(%5 : !stencil.field<[-1,1023]x[-1,511]xtensor<512xf32>>, %6 : tensor<510xf32>, %7 : tensor<510xf32>):
+      %cst = arith.constant 1.000000e+00 : f32
+      %8 = linalg.add ins(%6, %7 : tensor<510xf32>, tensor<510xf32>) outs(%6 : tensor<510xf32>) -> tensor<510xf32>
+      csl_stencil.yield %8 : tensor<510xf32>
+    }) to <[0, 0], [1, 1]>
+    func.return
+  }
 }
 
 
@@ -68,4 +83,25 @@ builtin.module {
 // CHECK-NEXT:     }) to <[0, 0], [1, 1]>
 // CHECK-NEXT:     func.return
 // CHECK-NEXT:   }
+// CHECK-NEXT:   func.func @bufferized_stencil_with_args(%a : memref<512xf32>, %b : memref<512xf32>) {
+// CHECK-NEXT:     %0 = tensor.empty() : tensor<510xf32>
+// CHECK-NEXT:     %1 = tensor.empty() : tensor<510xf32>
+// CHECK-NEXT:     %2 = bufferization.to_memref %0 : memref<510xf32>
+// CHECK-NEXT:     %3 = bufferization.to_memref %1 : memref<510xf32>
+// CHECK-NEXT:     csl_stencil.apply(%a : memref<512xf32>, %2 : memref<510xf32>, %3 : memref<510xf32>) outs (%b : memref<512xf32>) <{"swaps" = [#csl_stencil.exchange<to [1, 0]>, #csl_stencil.exchange<to [-1, 0]>, #csl_stencil.exchange<to [0, 1]>, #csl_stencil.exchange<to [0, -1]>], "topo" = #dmp.topo<1022x510>, "num_chunks" = 2 : i64, "bounds" = #stencil.bounds<[0, 0], [1, 1]>, "operandSegmentSizes" = array<i32: 1, 1, 1, 1>}> ({
+// CHECK-NEXT:     ^0(%4 : memref<4x255xf32>, %5 : index, %6 : memref<510xf32>):
+// CHECK-NEXT:       %7 = bufferization.to_tensor %6 restrict writable : memref<510xf32>
+// CHECK-NEXT:       %8 = bufferization.to_memref %7 : memref<510xf32>
+// CHECK-NEXT:       csl_stencil.yield %8 : memref<510xf32>
+// CHECK-NEXT:     }, {
+// CHECK-NEXT:     ^1(%9 : memref<512xf32>, %10 : memref<510xf32>, %11 : memref<510xf32>):
+// CHECK-NEXT:       %12 = bufferization.to_tensor %10 restrict writable : memref<510xf32>
+// CHECK-NEXT:       %13 = bufferization.to_tensor %11 restrict : memref<510xf32>
+// CHECK-NEXT:       %cst = arith.constant 1.000000e+00 : f32
+// CHECK-NEXT:       %14 = linalg.add ins(%12, %13 : tensor<510xf32>, tensor<510xf32>) outs(%12 : tensor<510xf32>) -> tensor<510xf32>
+// CHECK-NEXT:       %15 = bufferization.to_memref %14 : memref<510xf32>
+// CHECK-NEXT:       csl_stencil.yield %15 : memref<510xf32>
+// CHECK-NEXT:     }) to <[0, 0], [1, 1]>
+// CHECK-NEXT:     func.return
+// CHECK-NEXT:   }
 // CHECK-NEXT: }
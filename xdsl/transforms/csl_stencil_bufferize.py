@@ -1,5 +1,7 @@
-from collections.abc import Sequence
 from dataclasses import dataclass
+from functools import cache
+from itertools import chain
+from typing import cast
 
 from xdsl.context import MLContext
 from xdsl.dialects import arith, bufferization, func, linalg, memref, stencil, tensor
@@ -12,7 +14,7 @@ from xdsl.dialects.builtin import (
     i64,
 )
 from xdsl.dialects.csl import csl_stencil
-from xdsl.ir import Attribute, Block, BlockArgument, Operation, Region, SSAValue
+from xdsl.ir import Attribute, Operation, SSAValue
 from xdsl.passes import ModulePass
 from xdsl.pattern_rewriter import (
     GreedyRewritePatternApplier,
@@ -20,14 +22,17 @@ from xdsl.pattern_rewriter import (
     PatternRewriteWalker,
     RewritePattern,
     TypeConversionPattern,
-    attr_type_rewrite_pattern,
     op_type_rewrite_pattern,
 )
 from xdsl.rewriter import InsertPoint
 from xdsl.utils.hints import isa
-from xdsl.utils.isattr import isattr
 
+_FIELD_TENSOR_T = stencil.FieldType[TensorType[Attribute]]
+_STATIC_OFFSETS_DYN = DenseArrayBase.from_list(i64, (memref.Subview.DYNAMIC_INDEX,))
+_STATIC_STRIDES_ONE = DenseArrayBase.from_list(i64, (1,))
 
+
+@cache
 def tensor_to_memref_type(t: TensorType[Attribute]) -> memref.MemRefType[Attribute]:
     """Type conversion from tensor to memref."""
     return memref.MemRefType(t.get_element_type(), t.get_shape())
@@ -35,10 +40,9 @@ def tensor_to_memref_type(t: TensorType[Attribute]) -> memref.MemRefType[Attribu
 
 def to_memref_op(op: SSAValue) -> bufferization.ToMemrefOp:
     """Creates a `bufferization.to_memref` operation."""
-    assert isa(op.type, TensorType[Attribute])
-    r_type = memref.MemRefType(
-        op.type.get_element_type(), op.type.get_shape()
-    )  # todo set strided+offset here?
+    assert isinstance(op_type := op.type, TensorType)
+    # todo set strided+offset here?
+    r_type = tensor_to_memref_type(cast(TensorType[Attribute], op_type))
     return bufferization.ToMemrefOp(operands=[op], result_types=[r_type])
 
 
@@ -46,7 +50,7 @@ def to_tensor_op(
     op: SSAValue, writable: bool = False, restrict: bool = True
 ) -> bufferization.ToTensorOp:
     """Creates a `bufferization.to_tensor` operation."""
-    assert isa(op.type, memref.MemRefType[Attribute])
+    assert isinstance(op.type, memref.MemRefType)
     return bufferization.ToTensorOp(op, restrict, writable)
 
 
@@ -59,12 +63,14 @@ class StencilTypeConversion(TypeConversionPattern):
         `!stencil.field<[-1,1023]x[-1,511]xtensor<512xf32>` to `memref<512xf32>`
     """
 
-    @attr_type_rewrite_pattern
-    def convert_type(
-        self, typ: stencil.FieldType[TensorType[Attribute]]
-    ) -> memref.MemRefType[Attribute]:
+    def convert_type(self, typ: Attribute, /) -> memref.MemRefType[Attribute] | None:
+        if not isinstance(typ, stencil.FieldType):
+            return None
+        elem_t = cast(stencil.FieldType[Attribute], typ).get_element_type()
+        if not isinstance(elem_t, TensorType):
+            return None
         # todo should this convert to `memref` or `stencil.field<..xmemref<..>>`?
-        return tensor_to_memref_type(typ.get_element_type())
+        return tensor_to_memref_type(cast(TensorType[Attribute], elem_t))
 
 
 @dataclass(frozen=True)
@@ -77,75 +83,62 @@ class ApplyOpBufferize(RewritePattern):
 
     @op_type_rewrite_pattern
     def match_and_rewrite(self, op: csl_stencil.ApplyOp, rewriter: PatternRewriter, /):
-        if isa(op.accumulator.type, memref.MemRefType[Attribute]):
+        if isinstance(op.accumulator.type, memref.MemRefType):
             return
 
         # convert args
-        buf_args: list[SSAValue] = []
         to_memrefs: list[Operation] = [buf_iter_arg := to_memref_op(op.accumulator)]
-        for arg in op.args:
-            if isa(arg.type, TensorType[Attribute]):
-                to_memrefs.append(new_arg := to_memref_op(arg))
-                buf_args.append(new_arg.memref)
-            else:
-                buf_args.append(arg)
-
-        # create new op
-        buf_apply_op = csl_stencil.ApplyOp(
-            operands=[op.field, buf_iter_arg.memref, op.args, op.dest],
-            result_types=op.res.types or [[]],
-            regions=[
-                self._get_empty_bufferized_region(op.receive_chunk.block.args),
-                self._get_empty_bufferized_region(op.done_exchange.block.args),
-            ],
-            properties=op.properties,
-            attributes=op.attributes,
-        )
+        arg_conversions = [
+            ((m := to_memref_op(arg)).memref, m)
+            if isinstance(arg.type, TensorType)
+            else (arg, None)
+            for arg in op.args
+        ]
+        buf_args = [buf_arg for buf_arg, _ in arg_conversions]
+        to_memrefs.extend(m for _, m in arg_conversions if m is not None)
+
+        assert isinstance(typ := op.receive_chunk.block.args[0].type, TensorType)
+        typ = cast(TensorType[Attribute], typ)
+        chunk_type = TensorType(typ.get_element_type(), typ.get_shape()[1:])
 
-        # insert to_tensor ops and create arg mappings for block inlining
-        chunk_region_arg_mapping: Sequence[SSAValue] = []
-        for idx, (old_arg, arg) in enumerate(
-            zip(op.receive_chunk.block.args, buf_apply_op.receive_chunk.block.args)
-        ):
-            # arg0 has special meaning and does not need a `to_tensor` op
-            if isattr(old_arg.type, TensorType) and idx != 0:
-                rewriter.insert_op(
-                    # ensure iter_arg is writable
-                    t := to_tensor_op(arg, writable=idx == 2),
-                    InsertPoint.at_end(buf_apply_op.receive_chunk.block),
+        # convert block args in place and insert to_tensor ops for their uses
+        chunk_block = op.receive_chunk.block
+        chunk_region_arg_mapping: list[SSAValue] = []
+        chunk_to_tensors: list[Operation] = []
+        for idx, arg in enumerate(chunk_block.args):
+            if isinstance(arg_t := arg.type, TensorType):
+                rewriter.modify_value_type(
+                    arg, tensor_to_memref_type(cast(TensorType[Attribute], arg_t))
                 )
-                chunk_region_arg_mapping.append(t.tensor)
-            else:
-                chunk_region_arg_mapping.append(arg)
-
-        done_exchange_arg_mapping: Sequence[SSAValue] = []
-        for idx, (old_arg, arg) in enumerate(
-            zip(op.done_exchange.block.args, buf_apply_op.done_exchange.block.args)
-        ):
-            if isattr(old_arg.type, TensorType):
-                rewriter.insert_op(
+                # arg0 has special meaning and does not need a `to_tensor` op
+                if idx != 0:
                     # ensure iter_arg is writable
-                    t := to_tensor_op(arg, writable=idx == 1),
-                    InsertPoint.at_end(buf_apply_op.done_exchange.block),
+                    chunk_to_tensors.append(t := to_tensor_op(arg, writable=idx == 2))
+                    arg.replace_by_if(t.tensor, lambda use: use.operation is not t)
+                    chunk_region_arg_mapping.append(t.tensor)
+                    continue
+            chunk_region_arg_mapping.append(arg)
+        rewriter.insert_op(chunk_to_tensors, InsertPoint.at_start(chunk_block))
+
+        done_block = op.done_exchange.block
+        done_to_tensors: list[Operation] = []
+        for idx, arg in enumerate(done_block.args):
+            if isinstance(arg_t := arg.type, TensorType):
+                rewriter.modify_value_type(
+                    arg, tensor_to_memref_type(cast(TensorType[Attribute], arg_t))
                 )
-                done_exchange_arg_mapping.append(t.tensor)
-            else:
-                done_exchange_arg_mapping.append(arg)
-
-        assert isa(typ := op.receive_chunk.block.args[0].type, TensorType[Attribute])
-        chunk_type = TensorType(typ.get_element_type(), typ.get_shape()[1:])
-
-        # inline blocks from old into new regions
-        rewriter.inline_block(
-            op.receive_chunk.block,
-            InsertPoint.at_end(buf_apply_op.receive_chunk.block),
-            chunk_region_arg_mapping,
-        )
+                # ensure iter_arg is writable
+                done_to_tensors.append(t := to_tensor_op(arg, writable=idx == 1))
+                arg.replace_by_if(t.tensor, lambda use: use.operation is not t)
+        rewriter.insert_op(done_to_tensors, InsertPoint.at_start(done_block))
 
-        rewriter.inline_block(
-            op.done_exchange.block,
-            InsertPoint.at_end(buf_apply_op.done_exchange.block),
-            done_exchange_arg_mapping,
+        # create new op, moving over the converted regions
+        buf_apply_op = csl_stencil.ApplyOp(
+            operands=[op.field, buf_iter_arg.memref, buf_args, op.dest],
+            result_types=op.res.types or [[]],
+            regions=[op.detach_region(r) for r in op.regions],
+            properties=op.properties,
+            attributes=op.attributes,
         )
 
         self._inject_iter_arg_into_linalg_outs(
@@ -155,22 +148,6 @@ class ApplyOpBufferize(RewritePattern):
         # insert new op
         rewriter.replace_matched_op(new_ops=[*to_memrefs, buf_apply_op])
 
-    @staticmethod
-    def _get_empty_bufferized_region(args: Sequence[BlockArgument]) -> Region:
-        """Helper function to create a new region with bufferized arg types."""
-        return Region(
-            Block(
-                arg_types=[
-                    (
-                        tensor_to_memref_type(arg.type)
-                        if isattr(arg.type, TensorType)
-                        else arg.type
-                    )
-                    for arg in args
-                ]
-            )
-        )
-
     @staticmethod
     def _inject_iter_arg_into_linalg_outs(
         op: csl_stencil.ApplyOp,
@@ -204,13 +181,11 @@ class ApplyOpBufferize(RewritePattern):
                     operands=[iter_arg, [op.receive_chunk.block.args[1]], [], []],
                     result_types=[chunk_type],
                     properties={
-                        "static_offsets": DenseArrayBase.from_list(
-                            i64, (memref.Subview.DYNAMIC_INDEX,)
-                        ),
+                        "static_offsets": _STATIC_OFFSETS_DYN,
                         "static_sizes": DenseArrayBase.from_list(
                             i64, chunk_type.get_shape()
                         ),
-                        "static_strides": DenseArrayBase.from_list(i64, (1,)),
+                        "static_strides": _STATIC_STRIDES_ONE,
                     },
                 ),
                 type(linalg_op).build(
@@ -232,17 +207,17 @@ class ApplyOpBufferize(RewritePattern):
         """
 
         # this is the unbufferized `tensor<(neighbours)x(ZDim)x(type)>` value
-        assert isa(typ := op.receive_chunk.block.args[0].type, TensorType[Attribute])
+        assert isinstance(typ := op.receive_chunk.block.args[0].type, TensorType)
+        typ = cast(TensorType[Attribute], typ)
+        shape_tail = typ.get_shape()[1:]
 
         return tensor.ExtractSliceOp(
             operands=[to_tensor.tensor, [offset], [], []],
-            result_types=[TensorType(typ.get_element_type(), typ.get_shape()[1:])],
+            result_types=[TensorType(typ.get_element_type(), shape_tail)],
             properties={
-                "static_offsets": DenseArrayBase.from_list(
-                    i64, (memref.Subview.DYNAMIC_INDEX,)
-                ),
-                "static_sizes": DenseArrayBase.from_list(i64, typ.get_shape()[1:]),
-                "static_strides": DenseArrayBase.from_list(i64, (1,)),
+                "static_offsets": _STATIC_OFFSETS_DYN,
+                "static_sizes": DenseArrayBase.from_list(i64, shape_tail),
+                "static_strides": _STATIC_STRIDES_ONE,
             },
         )
 
@@ -259,9 +234,9 @@ class AccessOpBufferize(RewritePattern):
 
     @op_type_rewrite_pattern
     def match_and_rewrite(self, op: csl_stencil.AccessOp, rewriter: PatternRewriter, /):
-        if not isa(op.result.type, TensorType[Attribute]):
+        if not isinstance(res_type := op.result.type, TensorType):
             return
-        r_type = tensor_to_memref_type(op.result.type)
+        r_type = tensor_to_memref_type(cast(TensorType[Attribute], res_type))
 
         # accesses to own data that (after bufferization) have the same input and output type can be safely folded away
         if op.op.type == r_type and all(o == 0 for o in op.offset):
@@ -287,18 +262,18 @@ class YieldOpBufferize(RewritePattern):
 
     @op_type_rewrite_pattern
     def match_and_rewrite(self, op: csl_stencil.YieldOp, rewriter: PatternRewriter, /):
+        if not any(isinstance(arg.type, TensorType) for arg in op.arguments):
+            return
+
         to_memrefs: list[Operation] = []
         args: list[SSAValue] = []
         for arg in op.arguments:
-            if isa(arg.type, TensorType[Attribute]):
+            if isinstance(arg.type, TensorType):
                 to_memrefs.append(new_arg := to_memref_op(arg))
                 args.append(new_arg.memref)
             else:
                 args.append(arg)
 
-        if len(to_memrefs) == 0:
-            return
-
         rewriter.replace_matched_op([*to_memrefs, csl_stencil.YieldOp(*args)])
 
 
@@ -310,11 +285,16 @@ class FuncOpBufferize(RewritePattern):
 
     @op_type_rewrite_pattern
     def match_and_rewrite(self, op: func.FuncOp, rewriter: PatternRewriter, /):
+        if not any(
+            isa(t, _FIELD_TENSOR_T)
+            for t in chain(op.function_type.inputs, op.function_type.outputs)
+        ):
+            return
         function_type = FunctionType.from_lists(
             [
                 (
                     tensor_to_memref_type(t.get_element_type())
-                    if isa(t, stencil.FieldType[TensorType[Attribute]])
+                    if isa(t, _FIELD_TENSOR_T)
                     else t
                 )
                 for t in op.function_type.inputs
@@ -322,21 +302,19 @@ class FuncOpBufferize(RewritePattern):
             [
                 (
                     tensor_to_memref_type(t.get_element_type())
-                    if isa(t, stencil.FieldType[TensorType[Attribute]])
+                    if isa(t, _FIELD_TENSOR_T)
                     else t
                 )
                 for t in op.function_type.outputs
             ],
         )
-        if function_type == op.function_type:
-            return
         rewriter.replace_matched_op(
             func.FuncOp.build(
                 operands=op.operands,
                 result_types=op.result_types,
                 regions=[op.detach_region(op.body)],
                 properties={**op.properties, "function_type": function_type},
-                attributes=op.attributes.copy(),
+                attributes=op.attributes,
             )
         )
 
@@ -349,10 +327,11 @@ class ArithConstBufferize(RewritePattern):
 
     @op_type_rewrite_pattern
     def match_and_rewrite(self, op: arith.Constant, rewriter: PatternRewriter, /):
-        if not isa(op.result.type, TensorType[Attribute]):
+        if not isinstance(op.value, DenseIntOrFPElementsAttr):
+            return
+        if not isinstance(op.result.type, TensorType):
             return
-        assert isinstance(op.value, DenseIntOrFPElementsAttr)
-        assert isa(op.value.type, TensorType[Attribute])
+        assert isinstance(op.value.type, TensorType)
         typ = DenseIntOrFPElementsAttr(
             [tensor_to_memref_type(op.value.type), op.value.data]
         )
@@ -376,6 +355,9 @@ class CslStencilBufferize(ModulePass):
     name = "csl-stencil-bufferize"
 
     def apply(self, ctx: MLContext, op: ModuleOp) -> None:
+        # the patterns are not independent: `StencilTypeConversion` converts block args of
+        # `func.func` and `csl_stencil.apply` ops that still need to be revisited by
+        # `FuncOpBufferize` and `ApplyOpBufferize`, so this needs to run to a fixpoint
         module_pass = PatternRewriteWalker(
             GreedyRewritePatternApplier(
                 [